@@ -1,29 +1,87 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request
 from flask_cors import CORS
+import redis
 import requests
-import uuid
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from secrets import token_hex
+import struct
 import time
+import math
 import os
 import logging
+import orjson
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
 
 # -------------------------
 # Configuration
 # -------------------------
 FOURSQUARE_API_KEY = os.getenv("FOURSQUARE_API_KEY", "")
 ORS_API_KEY = os.getenv("ORS_API_KEY", "")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Idle rooms expire from Redis after this long; refreshed on join/location push
+ROOM_TTL_SECONDS = 24 * 3600
+
+# Venues fetched per location; bounds /api/venues results at len(locations) * VENUE_LIMIT
+VENUE_LIMIT = 5
+# Members closer than this (and than the search radius) to their centroid
+# share one Foursquare search
+BATCH_SPREAD_METERS = 2000
+# Foursquare's maximum page size, used for the shared search
+BATCH_LIMIT = 50
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
 
 if not FOURSQUARE_API_KEY:
-    print("⚠️ Warning: FOURSQUARE_API_KEY not set.")
+    log.warning("FOURSQUARE_API_KEY not set.")
 if not ORS_API_KEY:
-    print("⚠️ Warning: ORS_API_KEY not set.")
+    log.warning("ORS_API_KEY not set.")
 
 # -------------------------
 # Flask Setup
 # -------------------------
 app = Flask(__name__)
+app.json.compact = True
 CORS(app)
 
-logging.basicConfig(level=logging.INFO)
+def json_response(obj):
+    """JSON response encoded with orjson (bytes out, no stdlib json pass)"""
+    return app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+# -------------------------
+# HTTP Session (pooled)
+# -------------------------
+# Reuse TCP/TLS connections to ORS and Foursquare across requests
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+)
+SESSION.mount("https://api.openrouteservice.org", _adapter)
+SESSION.mount("https://places-api.foursquare.com", _adapter)
+
+# Shared worker pool for upstream fanout; avoids per-request thread start-up
+EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
+# -------------------------
+# Response Caches (in-memory)
+# -------------------------
+# Keyed on coordinates rounded to 4 decimals (~11 m) to raise the hit rate
+ISOCHRONE_CACHE = TTLCache(maxsize=10_000, ttl=3600)
+VENUE_CACHE = TTLCache(maxsize=10_000, ttl=3600)
+_cache_lock = threading.Lock()
+
+def _cache_get(cache, key):
+    with _cache_lock:
+        return cache.get(key)
+
+def _cache_set(cache, key, value):
+    with _cache_lock:
+        cache[key] = value
 
 # -------------------------
 # Isochrone Generator (ORS)
@@ -32,16 +90,27 @@ def get_isochrone(lat, lon, api_key=ORS_API_KEY, range_meters=1000):
     """Generate isochrone polygon from OpenRouteService"""
     if not api_key:
         return None
+
+    # Query ORS at the quantized point too, so a cached polygon is exactly
+    # the one for its key no matter which request populated it
+    lat, lon = round(float(lat), 4), round(float(lon), 4)
+    cache_key = (lat, lon, range_meters)
+    cached = _cache_get(ISOCHRONE_CACHE, cache_key)
+    if cached is not None:
+        return cached
+
     try:
         url = "https://api.openrouteservice.org/v2/isochrones/driving-car"
         headers = {"Authorization": api_key, "Content-Type": "application/json"}
         body = {"locations": [[lon, lat]], "range": [range_meters]}
 
-        resp = requests.post(url, headers=headers, json=body, timeout=10)
+        resp = SESSION.post(url, headers=headers, json=body, timeout=10)
         resp.raise_for_status()
-        return resp.json()
-    except requests.RequestException as e:
-        logging.error(f"ORS error: {e}")
+        isochrone = orjson.loads(resp.content)
+        _cache_set(ISOCHRONE_CACHE, cache_key, isochrone)
+        return isochrone
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
+        log.error("ORS error: %s", e)
         return None
 
 # -------------------------
@@ -52,16 +121,36 @@ class FoursquarePlaces:
         self.api_key = api_key
         self.api_version = api_version
         self.base_url = base_url
+        self.session = SESSION
         self.headers = {
             "Accept": "application/json",
             "Authorization": f"Bearer {self.api_key}",
             "X-Places-Api-Version": self.api_version
         }
 
+    @staticmethod
+    def _to_venue(place):
+        location = place.get("location") or {}
+        categories = place.get("categories") or [{}]
+        return {
+            "name": place.get("name", "Unknown"),
+            "address": location.get("formatted_address") or location.get("address", "No address"),
+            "category": categories[0].get("name", "Uncategorized"),
+            "lat": place.get("latitude"),
+            "lon": place.get("longitude")
+        }
+
     def search_places(self, query, latitude, longitude, radius=1000, limit=5):
         if not self.api_key:
             return []
 
+        # Search at the quantized point, matching the cache key (see get_isochrone)
+        latitude, longitude = round(float(latitude), 4), round(float(longitude), 4)
+        cache_key = (query.lower(), latitude, longitude, radius, limit)
+        cached = _cache_get(VENUE_CACHE, cache_key)
+        if cached is not None:
+            return cached
+
         try:
             url = f"{self.base_url}/search"
             params = {
@@ -70,45 +159,90 @@ class FoursquarePlaces:
                 "radius": radius,
                 "limit": limit
             }
-            resp = requests.get(url, headers=self.headers, params=params, timeout=10)
+            resp = self.session.get(url, headers=self.headers, params=params, timeout=10)
             resp.raise_for_status()
-            results = resp.json().get("results", [])
-
-            return [
-                {
-                    "name": place.get("name", "Unknown"),
-                    "address": (
-                        place.get("location", {}).get("formatted_address")
-                        or place.get("location", {}).get("address", "No address")
-                    ),
-                    "category": place.get("categories", [{}])[0].get("name", "Uncategorized")
-                }
-                for place in results
-            ]
-        except requests.RequestException as e:
-            logging.error(f"Foursquare error: {e}")
+            results = orjson.loads(resp.content).get("results", [])
+
+            venues = [self._to_venue(place) for place in results]
+            _cache_set(VENUE_CACHE, cache_key, venues)
+            return venues
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            log.error("Foursquare error: %s", e)
             return []
 
 # -------------------------
-# Room Management (in-memory)
+# Input Validation
 # -------------------------
-rooms = {}
+def _parse_number(value, kind=float):
+    # bool is an int subclass, so reject it explicitly
+    if isinstance(value, bool):
+        raise TypeError("boolean is not a number")
+    number = kind(value)
+    if not math.isfinite(number):
+        raise ValueError("number must be finite")
+    return number
+
+def _parse_lat_lon(lat, lon):
+    lat, lon = _parse_number(lat), _parse_number(lon)
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError("coordinate out of range")
+    return lat, lon
+
+# -------------------------
+# Room Management (Redis)
+# -------------------------
+# Rooms live in Redis so every Gunicorn worker sees the same state:
+#   room:<id>            hash  {"password": ...}
+#   room:<id>:members    hash  {clientId: name}
+#   room:<id>:locations  hash  {clientId: packed (lat, lon, timestamp)}
+# Replies are raw bytes since location records are binary.
+R = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+    REDIS_URL, max_connections=64
+))
+# 24-byte location record: lat, lon, timestamp as little-endian doubles
+LOCATION = struct.Struct("<ddd")
+_NO_FIX = (None, None, None)
 fs = FoursquarePlaces(FOURSQUARE_API_KEY)
 
+def _room_key(room_id):
+    return f"room:{room_id}"
+
+def _members_key(room_id):
+    return f"room:{room_id}:members"
+
+def _locations_key(room_id):
+    return f"room:{room_id}:locations"
+
+# HSETNX and EXPIRE in one atomic step, so a new room never lacks a TTL
+_create_room_script = R.register_script("""
+if redis.call("HSETNX", KEYS[1], "password", ARGV[1]) == 1 then
+    redis.call("EXPIRE", KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+""")
+
+def _touch_room(pipe, room_id):
+    # Keep all of a room's keys alive together
+    for key in (_room_key(room_id), _members_key(room_id), _locations_key(room_id)):
+        pipe.expire(key, ROOM_TTL_SECONDS)
+
 @app.route("/api/rooms", methods=["POST"])
 def create_room():
     try:
         data = request.json or {}
-        password = data.get("password", "")
-        room_id = str(uuid.uuid4())[:6]
+        password = str(data.get("password") or "")
+        room_id = token_hex(3)
 
-        rooms[room_id] = {"password": password, "members": {}}
-        logging.info(f"Room created: {room_id}")
+        # Only creates the room if the id is free, so retry on collision
+        while not _create_room_script(keys=[_room_key(room_id)], args=[password, ROOM_TTL_SECONDS]):
+            room_id = token_hex(3)
+        log.info("Room created: %s", room_id)
 
-        return jsonify({"roomId": room_id})
+        return json_response({"roomId": room_id})
     except Exception as e:
-        logging.exception("Error creating room")
-        return jsonify({"error": "Backend error creating room"}), 500
+        log.exception("Error creating room")
+        return json_response({"error": "Backend error creating room"}), 500
 
 @app.route("/api/rooms/<room_id>/join", methods=["POST"])
 def join_room(room_id):
@@ -116,27 +250,30 @@ def join_room(room_id):
         data = request.json or {}
         client_id = data.get("clientId")
         name = data.get("name")
-        password = data.get("password", "")
+        password = str(data.get("password") or "")
 
         if not client_id or not name:
-            return jsonify({"error": "Missing clientId or name"}), 400
-        if room_id not in rooms:
-            return jsonify({"error": "Room not found"}), 404
-        if rooms[room_id]["password"] and rooms[room_id]["password"] != password:
-            return jsonify({"error": "Invalid password"}), 403
-
-        rooms[room_id]["members"][client_id] = {
-            "name": name,
-            "lat": None,
-            "lon": None,
-            "timestamp": None
-        }
-        logging.info(f"{name} joined room {room_id}")
+            return json_response({"error": "Missing clientId or name"}), 400
+        if not isinstance(client_id, str) or not isinstance(name, str):
+            return json_response({"error": "clientId and name must be strings"}), 400
+        room_password = R.hget(_room_key(room_id), "password")
+        if room_password is None:
+            return json_response({"error": "Room not found"}), 404
+        if room_password and room_password.decode() != password:
+            return json_response({"error": "Invalid password"}), 403
 
-        return jsonify({"status": "joined"})
+        # (Re)joining clears any previous location for this client
+        pipe = R.pipeline()
+        pipe.hset(_members_key(room_id), client_id, name)
+        pipe.hdel(_locations_key(room_id), client_id)
+        _touch_room(pipe, room_id)
+        pipe.execute()
+        log.info("%s joined room %s", name, room_id)
+
+        return json_response({"status": "joined"})
     except Exception as e:
-        logging.exception("Error joining room")
-        return jsonify({"error": "Backend error joining room"}), 500
+        log.exception("Error joining room")
+        return json_response({"error": "Backend error joining room"}), 500
 
 @app.route("/api/rooms/<room_id>/locations", methods=["POST"])
 def push_location(room_id):
@@ -144,70 +281,178 @@ def push_location(room_id):
         data = request.json or {}
         client_id = data.get("clientId")
 
-        if room_id not in rooms or client_id not in rooms[room_id]["members"]:
-            return jsonify({"error": "Room/member not found"}), 404
+        if client_id is not None and not isinstance(client_id, str):
+            return json_response({"error": "clientId must be a string"}), 400
+        if not client_id or not R.hexists(_members_key(room_id), client_id):
+            return json_response({"error": "Room/member not found"}), 404
+
+        try:
+            lat, lon = _parse_lat_lon(data.get("lat"), data.get("lon"))
+        except (TypeError, ValueError, OverflowError):
+            return json_response({"error": "Invalid lat/lon"}), 400
 
-        rooms[room_id]["members"][client_id].update({
-            "lat": data.get("lat"),
-            "lon": data.get("lon"),
-            "timestamp": time.time()
-        })
-        return jsonify({"status": "location updated"})
+        pipe = R.pipeline()
+        pipe.hset(_locations_key(room_id), client_id, LOCATION.pack(lat, lon, time.time()))
+        _touch_room(pipe, room_id)
+        pipe.execute()
+        return json_response({"status": "location updated"})
     except Exception as e:
-        logging.exception("Error updating location")
-        return jsonify({"error": "Backend error updating location"}), 500
+        log.exception("Error updating location")
+        return json_response({"error": "Backend error updating location"}), 500
 
 @app.route("/api/rooms/<room_id>/locations", methods=["GET"])
 def get_locations(room_id):
     try:
-        if room_id not in rooms:
-            return jsonify({"error": "Room not found"}), 404
-
-        members = [
-            {"clientId": cid, **info}
-            for cid, info in rooms[room_id]["members"].items()
-        ]
-        return jsonify({"members": members})
+        # Existence check, members and locations in a single round-trip
+        pipe = R.pipeline(transaction=False)
+        pipe.exists(_room_key(room_id))
+        pipe.hgetall(_members_key(room_id))
+        pipe.hgetall(_locations_key(room_id))
+        exists, names, locations = pipe.execute()
+        if not exists:
+            return json_response({"error": "Room not found"}), 404
+
+        members = []
+        for cid, name in names.items():
+            # A missing or malformed record reads as "no location yet"
+            record = locations.get(cid)
+            lat, lon, ts = LOCATION.unpack(record) if record and len(record) == LOCATION.size else _NO_FIX
+            members.append({
+                "clientId": cid.decode(),
+                "name": name.decode(),
+                "lat": lat,
+                "lon": lon,
+                "timestamp": ts
+            })
+        return json_response({"members": members})
     except Exception as e:
-        logging.exception("Error fetching locations")
-        return jsonify({"error": "Backend error fetching locations"}), 500
+        log.exception("Error fetching locations")
+        return json_response({"error": "Backend error fetching locations"}), 500
+
+def dedupe_venues(venues):
+    """Drop repeated venues by case-insensitive (name, address), keeping the first"""
+    # Keys are built once up front as a single "name\0address" string rather
+    # than a tuple; dicts keep insertion order, first match wins.
+    keys = [
+        f"{(v['name'] or '').strip()}\x00{(v['address'] or '').strip()}".casefold()
+        for v in venues
+    ]
+    unique = {}
+    for key, v in zip(keys, venues):
+        unique.setdefault(key, v)
+    return list(unique.values())
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters between two lat/lon points"""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+def centroid_spread(coords):
+    """Centroid of coords and the distance from it to the farthest point"""
+    c_lat = sum(lat for lat, _ in coords) / len(coords)
+    c_lon = sum(lon for _, lon in coords) / len(coords)
+    spread = max(haversine_m(c_lat, c_lon, lat, lon) for lat, lon in coords)
+    return c_lat, c_lon, spread
+
+def cap_per_member(venues, coords, radius, limit):
+    """Keep venues within radius of a member, at most `limit` per member.
+
+    Each venue counts against the nearest member within radius that still
+    has room, in the given (relevance) order. Venues without coordinates
+    can't be placed and are dropped.
+    """
+    counts = [0] * len(coords)
+    kept = []
+    for v in venues:
+        if v["lat"] is None or v["lon"] is None:
+            continue
+        dists = sorted(
+            (haversine_m(lat, lon, v["lat"], v["lon"]), i) for i, (lat, lon) in enumerate(coords)
+        )
+        for dist, i in dists:
+            if dist > radius:
+                break
+            if counts[i] < limit:
+                counts[i] += 1
+                kept.append(v)
+                break
+    return kept
 
 @app.route("/api/venues", methods=["POST"])
 def get_venues():
     try:
         data = request.get_json() or {}
         query = data.get("query", "hospital")
-        radius = int(data.get("radius", 1000))
+        # search_places keys its cache on query.lower(), so make it a string
+        query = "" if query is None else str(query)
         locations = data.get("locations", [])
+        want_isochrone = bool(data.get("want_isochrone"))
+
+        # Validate and parse radius and every coordinate once, before any upstream call
+        try:
+            radius = _parse_number(data.get("radius", 1000), int)
+            coords = [_parse_lat_lon(lat, lon) for lat, lon in locations]
+        except (TypeError, ValueError, OverflowError):
+            return json_response({"error": "Invalid locations/radius"}), 400
+
+        # Fail fast when there is nothing to search or no key to search with
+        if not coords or radius <= 0:
+            return json_response({"venues": [], "isochrones": []} if want_isochrone else [])
+        if not fs.api_key and not want_isochrone:
+            return json_response([])
 
-        all_results = []
-        for loc in locations:
-            if len(loc) != 2:
-                continue
-            lat, lon = loc
+        # When members are close together, one search around their centroid
+        # covers everyone and replaces K overlapping per-member searches.
+        # Only batch when the spread is within the radius: otherwise each
+        # member's circle is a small slice of the shared search area and
+        # most of its results fall outside every member's radius.
+        batched = False
+        if fs.api_key and len(coords) > 1:
+            c_lat, c_lon, spread = centroid_spread(coords)
+            batched = spread <= min(radius, BATCH_SPREAD_METERS)
 
-            isochrone = get_isochrone(lat, lon, range_meters=radius)
-            if isochrone:
-                logging.info(f"Isochrone generated for {lat}, {lon}")
+        # Upstream calls are I/O-bound, so fan them out per location.
+        # Isochrones are only fetched when the client asks for them.
+        if batched:
+            futures = [EXECUTOR.submit(
+                fs.search_places, query, c_lat, c_lon,
+                radius=math.ceil(radius + spread), limit=BATCH_LIMIT
+            )]
+        else:
+            futures = [
+                EXECUTOR.submit(fs.search_places, query, lat, lon, radius=radius, limit=VENUE_LIMIT)
+                for lat, lon in coords
+            ] if fs.api_key else []
+        iso_futures = [
+            EXECUTOR.submit(get_isochrone, lat, lon, range_meters=radius)
+            for lat, lon in coords
+        ] if want_isochrone else []
 
-            results = fs.search_places(query, lat, lon, radius=radius, limit=5)
-            all_results.extend(results)
+        # Collect in submission order so the response stays deterministic.
+        # One comprehension pass instead of repeated extend() reallocs.
+        all_results = [r for future in futures for r in future.result()]
 
-        # Deduplicate venues
-        seen, unique_results = set(), []
-        for r in all_results:
-            key = (r["name"], r["address"])
-            if key not in seen:
-                seen.add(key)
-                unique_results.append(r)
+        unique_results = dedupe_venues(all_results)
+        if batched:
+            # Split the shared results across members, up to VENUE_LIMIT each.
+            # The shared search returns at most BATCH_LIMIT venues ranked
+            # around the centroid, so unlike per-member searches a member is
+            # not guaranteed VENUE_LIMIT venues of their own.
+            unique_results = cap_per_member(unique_results, coords, radius, VENUE_LIMIT)
 
-        return jsonify(unique_results)
+        if want_isochrone:
+            isochrones = [future.result() for future in iso_futures]
+            return json_response({"venues": unique_results, "isochrones": isochrones})
+        return json_response(unique_results)
     except Exception as e:
-        logging.exception("Error fetching venues")
-        return jsonify({"error": "Backend error fetching venues"}), 500
+        log.exception("Error fetching venues")
+        return json_response({"error": "Backend error fetching venues"}), 500
 
 # -------------------------
 # Run Server
 # -------------------------
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # Reloader and debugger only when explicitly asked for
+    app.run(host="0.0.0.0", port=5000, debug=os.getenv("FLASK_DEBUG") == "1", threaded=True)
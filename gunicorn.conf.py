@@ -0,0 +1,15 @@
+# -------------------------
+# Gunicorn Configuration
+# -------------------------
+# Run with: gunicorn app:app
+#
+# /api/venues spends nearly all its time waiting on ORS, Foursquare and
+# Redis, so use gevent workers: each worker multiplexes many in-flight
+# requests instead of blocking on one. The gevent worker monkey-patches
+# sockets and threads itself before importing the app (keep preload_app off).
+import os
+
+worker_class = "gevent"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+worker_connections = 1000
+keepalive = 30